@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+Compare wall time and bytes read when importing a plain CSV file with
+its gzip and zstd compressed equivalents. Uses a synthetic DPdash file
+unless one is given with --file.
+
+Compressed files are streamed through read calls, so their bytes read
+are taken from rchar in /proc/self/io. Plain files are memory mapped and
+every page of the file is faulted in, which rchar does not see, so their
+bytes read are reported as the file size.
+'''
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import argparse as ap
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from tools import reader
+
+def rchar():
+    # bytes read by this process through read syscalls, linux only
+    try:
+        with open('/proc/self/io', 'r') as fo:
+            for line in fo:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def generate(path, rows):
+    with open(path, 'w') as fo:
+        fo.write('reftime,day,timeofday,weekday,accel_x,accel_y,accel_z\n')
+        for i in range(rows):
+            fo.write('{0},{1},{2},{3},{4:.6f},{5:.6f},{6:.6f}\n'.format(
+                1500000000000 + i * 1000, i // 86400 + 1, i % 86400, i // 86400 % 7,
+                random.gauss(0, 1), random.gauss(0, 1), random.gauss(0, 1)))
+
+def compress(path):
+    paths = [path]
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    paths.append(path + '.gz')
+    try:
+        import zstandard
+    except ImportError:
+        print('zstandard is not installed, skipping .csv.zst')
+        return paths
+    with open(path, 'rb') as src, open(path + '.zst', 'wb') as dst:
+        zstandard.ZstdCompressor().copy_stream(src, dst)
+    paths.append(path + '.zst')
+    return paths
+
+def measure(func, path):
+    before = rchar()
+    start = timer()
+    result = func(path)
+    elapsed = timer() - start
+    after = rchar()
+    if not reader.compression(path) or before is None:
+        # memory mapped, or rchar is unavailable
+        read = os.path.getsize(path)
+    else:
+        read = after - before
+    return result, elapsed, read
+
+def main():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-n', '--rows', type=int, default=20000)
+    parser.add_argument('-f', '--file', help='Plain DPdash CSV file to benchmark')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'STUDY-SUB001-accel-day1to30.csv')
+        if args.file:
+            shutil.copy(args.file, path)
+        else:
+            generate(path, args.rows)
+        row = '{0:<10} {1:>12} {2:>10} {3:>14} {4:>10} {5:>14}'
+        print(row.format('file', 'size', 'read (s)', 'read (bytes)', 'count (s)', 'count (bytes)'))
+        for f in compress(path):
+            rows, read_time, read_bytes = measure(lambda p: sum(len(df) for df in reader.read_csv(p)), f)
+            counted, count_time, count_bytes = measure(reader.count_rows, f)
+            if rows != counted:
+                print('{0}: read {1} rows but counted {2}'.format(f, rows, counted))
+            _,ext = os.path.splitext(f)
+            print(row.format(ext, os.path.getsize(f), '{0:.3f}'.format(read_time), read_bytes,
+                '{0:.3f}'.format(count_time), count_bytes))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
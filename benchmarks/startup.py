@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+'''
+Measure the wall time of import.py runs where every matching file is
+already up to date. The first run imports anything that is missing and
+is not timed. Needs a database configured in the given config file.
+'''
+import os
+import sys
+import argparse as ap
+import subprocess as sp
+from timeit import default_timer as timer
+
+here = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(here, '..', 'scripts', 'import.py')
+
+def run(command, **kwargs):
+    start = timer()
+    sp.run(command, check=True, stdout=sp.DEVNULL, **kwargs)
+    return timer() - start
+
+def main():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-c', '--config', required=True)
+    parser.add_argument('-d', '--dbname', default='dpdata')
+    parser.add_argument('-n', '--repeat', type=int, default=10)
+    parser.add_argument('expr', nargs='+')
+    args = parser.parse_args()
+
+    command = [sys.executable, script, '-c', args.config, '-d', args.dbname] + args.expr
+
+    # bring the database up to date first
+    run(command, stderr=sp.DEVNULL)
+
+    # nothing should be imported, so pandas should never be loaded
+    proc = sp.run([sys.executable, '-X', 'importtime'] + command[1:],
+        check=True, stdout=sp.DEVNULL, stderr=sp.PIPE, universal_newlines=True)
+    if any(line.rstrip().endswith('| pandas') for line in proc.stderr.splitlines()):
+        print('warning: pandas was imported during a no-op run')
+
+    times = [run(command, stderr=sp.DEVNULL) for _ in range(args.repeat)]
+    print('no-op run best={0:.3f}s mean={1:.3f}s'.format(min(times), sum(times) / len(times)))
+
+if __name__ == '__main__':
+    main()
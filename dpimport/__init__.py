@@ -21,7 +21,7 @@ def probe(path):
     :type path: str
     '''
     if not os.path.exists(path):
-        logger.debug('file not found %s', f)
+        logger.debug('file not found %s', path)
         return None
     dirname = os.path.dirname(path)
     basename = os.path.basename(path)
@@ -36,7 +36,7 @@ def probe(path):
         info.update(init_datafile(info))
         info['glob'] = get_glob(path)
     # add other necessary information to info object
-    mimetype,encoding = mt.guess_type(path)
+    mimetype,encoding = guess_type(path)
     stat = os.stat(path)
     info.update({
         'path' : path,
@@ -84,7 +84,29 @@ def get_glob(f):
     basename = os.path.basename(f)
     dirname = os.path.dirname(f)
     glob = patterns.GLOB_SUB.sub('\\1*\\2', basename)
-    return os.path.join(dirname, glob)
+    return os.path.join(dirname, glob_extension(glob))
+
+def glob_extension(glob):
+    '''
+    Widen the extension of a glob so the plain and compressed versions
+    of a file belong to the same glob
+
+    :param glob: File glob
+    :type glob: str
+    '''
+    return patterns.EXTENSION_SUB.sub('\\1*', glob)
+
+def guess_type(path):
+    '''
+    Guess the mime type and encoding of a file from its name
+
+    :param path: File path
+    :type path: str
+    '''
+    if path.endswith('.zst'):
+        # mimetypes treats .zst as a file type rather than an encoding
+        return mt.guess_type(path[:-4])[0], 'zstd'
+    return mt.guess_type(path)
 
 def import_file(db, file_info):
     if file_info['role'] == 'data':
@@ -1,8 +1,9 @@
 import ssl
+import socket
 import fnmatch
 import logging
-from pymongo import MongoClient
-from bson.json_util import dumps
+import threading
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
@@ -14,22 +15,30 @@ class Database(object):
         self.db = None
 
     def connect(self):
+        # pymongo is expensive to import, defer it until we connect
+        from pymongo import MongoClient
         uri = 'mongodb://{USERNAME}:{PASSWORD}@{HOST}:{PORT}/{AUTH_SOURCE}'
+        if not self.config.get('username'):
+            # unauthenticated, e.g. a local mongod used for testing
+            uri = 'mongodb://{HOST}:{PORT}/'
         uri = uri.format(
-            USERNAME=self.config['username'],
-            PASSWORD=self.config['password'],
+            USERNAME=self.config.get('username'),
+            PASSWORD=self.config.get('password'),
             HOST=self.config['hostname'],
             PORT=self.config['port'],
-            AUTH_SOURCE=self.config['auth_source']
-        )
-        self.client = MongoClient(
-            uri,
-            ssl=True,
-            ssl_cert_reqs=ssl.CERT_REQUIRED,
-            ssl_certfile=self.config['ssl_certfile'],
-            ssl_keyfile=self.config['ssl_keyfile'],
-            ssl_ca_certs=self.config['ssl_ca_certs']
+            AUTH_SOURCE=self.config.get('auth_source')
         )
+        if self.config.get('ssl', True):
+            self.client = MongoClient(
+                uri,
+                ssl=True,
+                ssl_cert_reqs=ssl.CERT_REQUIRED,
+                ssl_certfile=self.config['ssl_certfile'],
+                ssl_keyfile=self.config['ssl_keyfile'],
+                ssl_ca_certs=self.config['ssl_ca_certs']
+            )
+        else:
+            self.client = MongoClient(uri)
         self.db = self.client[self.dbname]
         return self
 
@@ -57,18 +66,26 @@ class Database(object):
             logger.debug('dropping collection %s', collection)
             self.db[collection].drop()
             logger.debug('deleting toc document %s', _id)
-            self.db.toc.remove({ '_id': _id })
+            self.db.toc.delete_one({ '_id': _id })
 
     def exists(self, probe):
         '''
-        Check if file exists in the database
+        Check if file exists in the database, was completely imported
+        and was not flagged for reimport by verification. Entries left
+        dirty by an import that never finished don't count.
 
         :param probe: File probe
         :type probe: dict
         '''
         doc = self.db.toc.find_one({
             'path': probe['path'],
-            'size': probe['size']
+            'size': probe['size'],
+            'dirty': {
+                '$ne': True
+            },
+            'verified': {
+                '$ne': False
+            }
         })
         if doc:
             return True
@@ -94,3 +111,218 @@ class Database(object):
             }
         })
 
+    def acquire_lease(self, key, owner, ttl):
+        '''
+        Claim the lease for a key in the coordination collection. A lease
+        can be claimed if nobody holds it, the current holder is owner,
+        or the previous holder stopped renewing it and it has expired.
+
+        :param key: Lease key, typically a file glob
+        :type key: str
+        :param owner: Worker identifier
+        :type owner: str
+        :param ttl: Lease duration in seconds
+        :type ttl: int
+        '''
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.utcnow()
+        try:
+            self.db.leases.update_one({
+                '_id': key,
+                '$or': [
+                    { 'expires': { '$lt': now } },
+                    { 'owner': owner }
+                ]
+            }, {
+                '$set': {
+                    'owner': owner,
+                    'acquired': now,
+                    'expires': now + timedelta(seconds=ttl)
+                }
+            }, upsert=True)
+        except DuplicateKeyError:
+            # the lease exists and is held by a live worker
+            return False
+        return True
+
+    def release_lease(self, key, owner):
+        '''
+        Release a lease held by owner
+
+        :param key: Lease key
+        :type key: str
+        :param owner: Worker identifier
+        :type owner: str
+        '''
+        self.db.leases.delete_one({
+            '_id': key,
+            'owner': owner
+        })
+
+    def start_worker(self, owner, run):
+        '''
+        Reset the throughput counters of a worker at the start of a run
+
+        :param owner: Worker identifier
+        :type owner: str
+        :param run: Run identifier shared by the workers of one import
+        :type run: str
+        '''
+        now = datetime.utcnow()
+        self.db.workers.replace_one({
+            '_id': owner
+        }, {
+            'run': run,
+            'hostname': socket.gethostname(),
+            'started': now,
+            'heartbeat': now,
+            'files': 0,
+            'bytes': 0
+        }, upsert=True)
+
+    def renew_leases(self, owner, ttl):
+        '''
+        Extend every lease held by owner and record a worker heartbeat
+
+        :param owner: Worker identifier
+        :type owner: str
+        :param ttl: Lease duration in seconds
+        :type ttl: int
+        '''
+        now = datetime.utcnow()
+        self.db.leases.update_many({
+            'owner': owner
+        }, {
+            '$set': {
+                'expires': now + timedelta(seconds=ttl)
+            }
+        })
+        self.db.workers.update_one({
+            '_id': owner
+        }, {
+            '$set': {
+                'heartbeat': now
+            }
+        })
+
+    def record_progress(self, owner, size):
+        '''
+        Add an imported file to the worker throughput counters
+
+        :param owner: Worker identifier
+        :type owner: str
+        :param size: Imported file size in bytes
+        :type size: int
+        '''
+        self.db.workers.update_one({
+            '_id': owner
+        }, {
+            '$inc': {
+                'files': 1,
+                'bytes': size
+            },
+            '$set': {
+                'heartbeat': datetime.utcnow()
+            }
+        })
+
+    def throughput(self, run):
+        '''
+        Summarize imported files and bytes per node for one run, along
+        with the time span the workers on that node were active.
+
+        :param run: Run identifier
+        :type run: str
+        '''
+        return list(self.db.workers.aggregate([
+            {
+                '$match': { 'run': run }
+            },
+            {
+                '$group': {
+                    '_id': '$hostname',
+                    'workers': { '$sum': 1 },
+                    'files': { '$sum': '$files' },
+                    'bytes': { '$sum': '$bytes' },
+                    'started': { '$min': '$started' },
+                    'heartbeat': { '$max': '$heartbeat' }
+                }
+            },
+            {
+                '$sort': { '_id': 1 }
+            }
+        ]))
+
+    def backlog(self):
+        '''
+        List file paths left over from runs that ran out of time,
+        oldest first.
+        '''
+        cursor = self.db.backlog.find({}, {
+            '_id': True
+        }).sort('queued', 1)
+        return [doc['_id'] for doc in cursor]
+
+    def enqueue(self, probes):
+        '''
+        Add file probes to the backlog
+
+        :param probes: File probes
+        :type probes: list
+        '''
+        from pymongo import UpdateOne
+        now = datetime.utcnow()
+        requests = [UpdateOne({
+            '_id': probe['path']
+        }, {
+            '$set': {
+                'study': probe['study'],
+                'mtime': probe['mtime'],
+                'size': probe['size']
+            },
+            '$setOnInsert': {
+                'queued': now
+            }
+        }, upsert=True) for probe in probes]
+        if requests:
+            self.db.backlog.bulk_write(requests, ordered=False)
+
+    def dequeue(self, paths):
+        '''
+        Remove file paths from the backlog
+
+        :param paths: File paths
+        :type paths: list
+        '''
+        if paths:
+            self.db.backlog.delete_many({
+                '_id': {
+                    '$in': list(paths)
+                }
+            })
+
+class Heartbeat(threading.Thread):
+    '''
+    Background thread that periodically renews the leases held by a
+    worker. If the worker dies the renewals stop and its leases expire
+    so other workers can claim them.
+    '''
+    def __init__(self, database, owner, ttl):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.database = database
+        self.owner = owner
+        self.ttl = ttl
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.database.renew_leases(self.owner, self.ttl)
+            except Exception as e:
+                logger.error(e)
+            if self.stopped.wait(self.ttl / 3.0):
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
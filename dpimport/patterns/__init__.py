@@ -1,7 +1,9 @@
 import re
 
-DATAFILE = re.compile(r'(?P<study>\w+)\-(?P<subject>\w+)\-(?P<assessment>\w+)\-(?P<units>day)(?P<start>[+-]?\d+(?:\.\d+)?)to(?P<end>[+-]?\d+(?:\.\d+)?)(?P<extension>.csv)')
+DATAFILE = re.compile(r'(?P<study>\w+)\-(?P<subject>\w+)\-(?P<assessment>\w+)\-(?P<units>day)(?P<start>[+-]?\d+(?:\.\d+)?)to(?P<end>[+-]?\d+(?:\.\d+)?)(?P<extension>\.csv(?:\.gz|\.zst)?)$')
 
-METADATA = re.compile(r'(?P<study>\w+)\_metadata(?P<extension>.csv)')
+METADATA = re.compile(r'(?P<study>\w+)\_metadata(?P<extension>\.csv(?:\.gz|\.zst)?)$')
 
 GLOB_SUB = re.compile(r'(\w+\-\w+\-\w+\-day)[+-]?\d+(?:\.\d+)?to[+-]?\d+(?:\.\d+)?(.*)')
+
+EXTENSION_SUB = re.compile(r'(\.csv)(?:\.gz|\.zst)?$')
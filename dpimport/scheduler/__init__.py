@@ -0,0 +1,60 @@
+import logging
+import itertools
+import collections as col
+
+logger = logging.getLogger(__name__)
+
+class Policy:
+    NONE        = 'none'
+    NEWEST      = 'newest'
+    SMALLEST    = 'smallest'
+    FAIR        = 'fair'
+
+POLICIES = [
+    Policy.NEWEST,
+    Policy.SMALLEST,
+    Policy.FAIR,
+    Policy.NONE
+]
+
+def schedule(probes, policy=Policy.NEWEST, first=None):
+    '''
+    Order file probes for import. Probes whose path is in first,
+    typically the backlog left over from a previous run, are placed
+    ahead of everything else and both groups are ordered by policy.
+
+    :param probes: File probes
+    :type probes: list
+    :param policy: Scheduling policy
+    :type policy: str
+    :param first: Paths to schedule first
+    :type first: set
+    '''
+    first = first or set()
+    head = [p for p in probes if p['path'] in first]
+    tail = [p for p in probes if p['path'] not in first]
+    return order(head, policy) + order(tail, policy)
+
+def order(probes, policy):
+    '''
+    Order file probes according to a single policy
+
+    :param probes: File probes
+    :type probes: list
+    :param policy: Scheduling policy
+    :type policy: str
+    '''
+    if policy == Policy.NONE:
+        return list(probes)
+    if policy == Policy.NEWEST:
+        return sorted(probes, key=lambda p: p['mtime'], reverse=True)
+    if policy == Policy.SMALLEST:
+        return sorted(probes, key=lambda p: p['size'])
+    if policy == Policy.FAIR:
+        # take turns between studies, newest files first within a study
+        studies = col.OrderedDict()
+        for p in order(probes, Policy.NEWEST):
+            studies.setdefault(p['study'], []).append(p)
+        rounds = itertools.zip_longest(*studies.values())
+        return [p for p in itertools.chain.from_iterable(rounds) if p is not None]
+    raise ValueError('unknown scheduling policy {0}'.format(policy))
@@ -3,10 +3,13 @@ import re
 import logging
 import hashlib
 import uuid
-import mimetypes as mt
+import json
 from datetime import datetime
 from urllib.parse import quote
+from pymongo import ReplaceOne, DeleteMany
+from pymongo.errors import BulkWriteError
 
+import dpimport
 from tools import database as dbtools
 from tools import reader
 
@@ -15,12 +18,18 @@ TIME_UNITS = {
     'hr' : 'hours'
 }
 
+# Column used to match rows when diffing metadata files
+METADATA_KEY = 'Subject ID'
+
+# Number of records inserted at once
+BATCH_SIZE = 100000
+
 _UNITS = '|'.join(TIME_UNITS.keys())
-_EXTENSION = '.csv'
+_EXTENSION = r'\.csv(?:\.gz|\.zst)?'
 
-FILE_REGEX = re.compile(r'(?P<study>\w+)\-(?P<subject>\w+)\-(?P<assessment>\w+)\-(?P<units>{UNITS})(?P<start>[+-]?\d+(?:\.\d+)?)to(?P<end>[+-]?\d+(?:\.\d+)?)(?P<extension>{EXTENSION})'.format(UNITS=_UNITS, EXTENSION=_EXTENSION))
+FILE_REGEX = re.compile(r'(?P<study>\w+)\-(?P<subject>\w+)\-(?P<assessment>\w+)\-(?P<units>{UNITS})(?P<start>[+-]?\d+(?:\.\d+)?)to(?P<end>[+-]?\d+(?:\.\d+)?)(?P<extension>{EXTENSION})$'.format(UNITS=_UNITS, EXTENSION=_EXTENSION))
 FILE_SUB =  re.compile(r'(\w+\-\w+\-\w+\-{UNITS})[+-]?\d+(?:\.\d+)?to[+-]?\d+(?:\.\d+)?(.*)'.format(UNITS=_UNITS))
-METADATA_REGEX = re.compile(r'(?P<study>\w+)\_metadata(?P<extension>{EXTENSION})'.format(EXTENSION='.csv'))
+METADATA_REGEX = re.compile(r'(?P<study>\w+)\_metadata(?P<extension>{EXTENSION})$'.format(EXTENSION=_EXTENSION))
 
 logger = logging.getLogger(__name__)
 
@@ -52,34 +61,130 @@ def stat_file(import_dir, file_name, file_path):
 
     return file_info
 
-def import_file(db, file_info):
+# Import a file, returns 0 on success and 1 on failure
+def import_file(db, file_info, diff_metadata=False):
     if file_info['role'] == 'data':
         collection = db['toc']
     elif file_info['role'] == 'metadata':
         collection = db['metadata']
     else:
         logger.error('{FILE} is not compatible with DPdash. Exiting import.'.format(FILE=file_info['path']))
-        return
+        return 1
 
-    diff_files(db, collection, file_info)
+    return diff_files(db, collection, file_info, diff_metadata)
 
 # Match the file info with the record stored in the database
-def diff_files(db, collection, file_info):
+def diff_files(db, collection, file_info, diff_metadata=False):
     file_path = file_info['path']
     db_data = collection.find_one({ 'path' : file_path })
     if not db_data:
         logger.info('{FILE} does not exist in the database. Importing.'.format(FILE=file_path))
-        import_data(db, collection, file_info)
+        return import_data(db, collection, file_info)
     else:
-        if db_data['mtime'] != file_info['mtime'] or db_data['size'] != file_info['size']:
+        if db_data['mtime'] != file_info['mtime'] or db_data['size'] != file_info['size'] or db_data.get('verified') is False:
+            if diff_metadata and file_info['role'] == 'metadata' and 'collection' in db_data:
+                logger.info('{FILE} has been modified. Updating changed rows.'.format(FILE=file_path))
+                return update_metadata(db, collection, db_data, file_info)
             logger.info('{FILE} has been modified. Re-importing.'.format(FILE=file_path))
             dbtools.remove_doc(db, collection, db_data, file_info['role'])
-            import_data(db, collection, file_info)
+            return import_data(db, collection, file_info)
         else:
             logger.info('Database already has {FILE}. Skipping.'.format(FILE=file_path))
             logged = log_success(collection, db_data['_id'])
             if logged == 0:
                 logger.info('Journaling complete for {FILE}'.format(FILE=file_info['path']))
+            return 0
+
+# Apply the rows that changed in a metadata file to its existing collection
+def update_metadata(db, ref_collection, db_data, file_info, key=METADATA_KEY):
+    file_info['collection'] = db_data['collection']
+    counts = dict()
+    try:
+        updated = update_rows(db, file_info, key, counts)
+    except DiffError as e:
+        # rows cannot be matched one to one, reload the whole file instead
+        logger.warning('{ERROR}. Re-importing {FILE}.'.format(ERROR=e, FILE=file_info['path']))
+        del file_info['collection']
+        dbtools.remove_doc(db, ref_collection, db_data, file_info['role'])
+        return import_data(db, ref_collection, file_info)
+    if updated != 0:
+        logger.error('Unable to update {FILE}'.format(FILE=file_info['path']))
+        return 1
+
+    reference = dict(file_info)
+    reference.pop('_id', None)
+    # every row of the file is stored once the bulk write succeeds, keep
+    # the counts verify_file compares against current
+    reference.update({
+        'rows' : counts['rows'],
+        'inserted' : counts['rows']
+    })
+    try:
+        ref_collection.update_one({
+            '_id' : db_data['_id']
+        }, {
+            '$set' : reference,
+            '$unset' : {
+                'batches' : True,
+                'verified' : True
+            }
+        })
+    except Exception as e:
+        logger.error(e)
+        return 1
+
+    logger.info('Import success for {FILE}'.format(FILE=file_info['path']))
+    logged = log_success(ref_collection, db_data['_id'])
+    if logged == 0:
+        logger.info('Journaling complete for {FILE}'.format(FILE=file_info['path']))
+    return 0
+
+# Upsert added or changed rows and delete removed rows, keyed on a column.
+# Raises DiffError if the key does not identify rows uniquely. The number
+# of rows in the file is stored in counts.
+def update_rows(db, file_info, key, counts=None):
+    if counts is None:
+        counts = {}
+    try:
+        rows = dict()
+        for chunk in reader.read_csv(file_info['path']):
+            if len(chunk) > 0:
+                chunk['path'] = file_info['path']
+                for row in chunk.to_dict('records'):
+                    if key not in row:
+                        raise DiffError('{FILE} has no {KEY} column'.format(FILE=file_info['path'], KEY=key))
+                    if row[key] in rows:
+                        raise DiffError('duplicate {KEY} {VALUE} in {FILE}'.format(KEY=key, VALUE=row[key], FILE=file_info['path']))
+                    rows[row[key]] = row
+
+        import_collection = db[file_info['collection']]
+        stored = dict()
+        for doc in import_collection.find({}):
+            doc.pop('_id')
+            if doc.get(key) in stored:
+                raise DiffError('duplicate {KEY} {VALUE} in collection {COLLECTION}'.format(KEY=key, VALUE=doc.get(key), COLLECTION=file_info['collection']))
+            stored[doc.get(key)] = doc
+
+        requests = list()
+        for value,row in iter(rows.items()):
+            if stored.get(value) != row:
+                requests.append(ReplaceOne({ key : value }, row, upsert=True))
+        removed = [value for value in stored if value not in rows]
+        if removed:
+            requests.append(DeleteMany({ key : { '$in' : removed } }))
+
+        logger.info('{FILE}: {CHANGED} rows added or changed, {REMOVED} removed'.format(
+            FILE=file_info['path'], CHANGED=len(requests) - bool(removed), REMOVED=len(removed)))
+        if requests:
+            import_collection.bulk_write(requests, ordered=True)
+        counts['rows'] = len(rows)
+        return 0
+    except DiffError:
+        raise
+    except Exception as e:
+        logger.error(e)
+        logger.error('Unable to update {FILE}'.format(FILE=file_info['path']))
+        return 1
 
 # Import data into the database
 def import_data(db, ref_collection, file_info):
@@ -88,15 +193,19 @@ def import_data(db, ref_collection, file_info):
     ref_id = insert_reference(ref_collection, file_info)
     if ref_id is None:
         logger.error('Unable to import {FILE}'.format(FILE=file_info['path']))
-        return
+        return 1
 
-    inserted = insert_data(db, file_info)
-    if inserted == 0:
-        logger.info('Import success for {FILE}'.format(FILE=file_info['path']))
+    batches = list()
+    inserted = insert_data(db, file_info, batches)
+    record_batches(ref_collection, ref_id, batches)
+    if inserted != 0:
+        return 1
+    logger.info('Import success for {FILE}'.format(FILE=file_info['path']))
 
-        logged = log_success(ref_collection, ref_id)
-        if logged == 0:
-            logger.info('Journaling complete for {FILE}'.format(FILE=file_info['path']))
+    logged = log_success(ref_collection, ref_id)
+    if logged == 0:
+        logger.info('Journaling complete for {FILE}'.format(FILE=file_info['path']))
+    return 0
 
 # Mark the sync as successful
 def log_success(ref_collection, ref_id):
@@ -109,7 +218,7 @@ def log_success(ref_collection, ref_id):
     }
 
     try:
-        ref_collection.update({
+        ref_collection.update_one({
             '_id' : ref_id
         }, update_ref)
         return 0
@@ -126,31 +235,139 @@ def insert_reference(collection, reference):
         logger.error(e)
         return None
 
-# Insert the data
-def insert_data(db, file_info):
+# Insert the data, recording the row count and checksum of each batch
+def insert_data(db, file_info, batches=None):
+    if batches is None:
+        batches = []
     try:
-        # Import data
-        data_blob = []
         import_collection = db[file_info['collection']]
-        for chunk in reader.read_csv(file_info['path']):
-            if len(chunk) > 0:
-                if file_info['role'] != 'metadata':
-                    chunk_columns = sanitize_columns(chunk.columns.values.tolist())
-                    chunk.columns = chunk_columns
-                chunk['path'] = file_info['path']
-                data_blob.extend(chunk.to_dict('records'))
-
-                if len(data_blob) >= 100000:
-                    import_collection.insert_many(data_blob, False)
-                    data_blob = []
-        if data_blob:
-            import_collection.insert_many(data_blob, False)
+        for data_blob in read_batches(file_info):
+            batch = {
+                'rows' : len(data_blob),
+                'inserted' : 0,
+                'checksum' : checksum(data_blob)
+            }
+            batches.append(batch)
+            try:
+                result = import_collection.insert_many(data_blob, False)
+                batch['inserted'] = len(result.inserted_ids)
+            except BulkWriteError as e:
+                batch['inserted'] = e.details.get('nInserted', 0)
+                raise
         return 0
     except Exception as e:
         logger.error(e)
         logger.error('Unable to import {FILE}'.format(FILE=file_info['path']))
         return 1
 
+# Read the file and yield lists of records to insert
+def read_batches(file_info, batch_size=None):
+    batch_size = batch_size or BATCH_SIZE
+    data_blob = []
+    for chunk in reader.read_csv(file_info['path']):
+        if len(chunk) > 0:
+            if file_info['role'] != 'metadata':
+                chunk_columns = sanitize_columns(chunk.columns.values.tolist())
+                chunk.columns = chunk_columns
+            chunk['path'] = file_info['path']
+            data_blob.extend(chunk.to_dict('records'))
+
+            if len(data_blob) >= batch_size:
+                yield data_blob
+                data_blob = []
+    if data_blob:
+        yield data_blob
+
+# Checksum a batch of records before it is inserted
+def checksum(records):
+    blob = json.dumps(records, sort_keys=True, default=str)
+    return hashlib.md5(blob.encode('utf-8')).hexdigest()
+
+# Save the batches written during import to the reference doc
+def record_batches(ref_collection, ref_id, batches):
+    try:
+        ref_collection.update_one({
+            '_id' : ref_id
+        }, {
+            '$set' : {
+                'rows' : sum(batch['rows'] for batch in batches),
+                'inserted' : sum(batch['inserted'] for batch in batches),
+                'batches' : batches
+            }
+        })
+        return 0
+    except Exception as e:
+        logger.error(e)
+        return 1
+
+# Compare a file against the counts recorded when it was imported. Returns
+# None if the file was imported without recording counts.
+def verify_file(db, file_info, checksums=False):
+    if file_info['role'] == 'data':
+        ref_collection = db['toc']
+    else:
+        ref_collection = db['metadata']
+    ref = ref_collection.find_one({
+        'path' : file_info['path'],
+        'size' : file_info['size']
+    })
+    if not ref or 'rows' not in ref:
+        return None
+
+    try:
+        rows = reader.count_rows(file_info['path'])
+    except Exception as e:
+        # e.g. a zstd file without the zstandard package installed
+        logger.error(e)
+        logger.error('Unable to verify {FILE}'.format(FILE=file_info['path']))
+        return None
+    if rows is None:
+        # the file can't be counted without parsing it, count what was stored
+        rows = ref['rows']
+        inserted = db[ref['collection']].count_documents({
+            'path' : file_info['path']
+        })
+    else:
+        inserted = ref['inserted']
+    if rows != ref['rows'] or inserted != ref['rows']:
+        logger.warning('{FILE} has {ROWS} rows, {PARSED} were read and {INSERTED} inserted'.format(
+            FILE=file_info['path'], ROWS=rows, PARSED=ref['rows'], INSERTED=inserted))
+        flag_file(ref_collection, ref['_id'])
+        return False
+
+    if checksums and 'batches' in ref:
+        # re-reads the file, but still avoids scanning the collection
+        expected = [batch['checksum'] for batch in ref['batches']]
+        try:
+            actual = [checksum(data_blob) for data_blob in read_batches(file_info)]
+        except Exception as e:
+            logger.error(e)
+            logger.error('Unable to verify {FILE}'.format(FILE=file_info['path']))
+            return None
+        if actual != expected:
+            logger.warning('{FILE} checksums do not match the imported batches'.format(FILE=file_info['path']))
+            flag_file(ref_collection, ref['_id'])
+            return False
+
+    return True
+
+# Mark the reference doc so the file is imported again on the next run
+def flag_file(ref_collection, ref_id):
+    try:
+        ref_collection.update_one({
+            '_id' : ref_id
+        }, {
+            '$set' : {
+                'dirty' : True,
+                'synced' : False,
+                'verified' : False
+            }
+        })
+        return 0
+    except Exception as e:
+        logger.error(e)
+        return 1
+
 # Rename columns to encode special characters
 def sanitize_columns(columns):
     new_columns = []
@@ -193,13 +410,13 @@ def scan_data(match, file_name, sub_dir):
         STUDY= file_info['study'],
         SUBJECT=file_info['subject'],
         ASSESSMENT=file_info['assessment'] 
-    ))
+    ).encode('utf-8'))
 
     file_info.update({
         'collection': m.hexdigest(),
         'subject' : file_info['subject'],
         'assessment' : file_info['assessment'],
-        'glob' : os.path.join(sub_dir, FILE_SUB.sub('\\1*\\2', file_name)),
+        'glob' : os.path.join(sub_dir, dpimport.glob_extension(FILE_SUB.sub('\\1*\\2', file_name))),
         'time_units' : str(file_info['units']),
         'time_start' : int(file_info['start']),
         'time_end' : int(file_info['end']),
@@ -210,10 +427,13 @@ def scan_data(match, file_name, sub_dir):
 
 # get mime type and encoding
 def guess_type(extension):
-    return mt.guess_type('file{}'.format(extension))
+    return dpimport.guess_type('file{}'.format(extension))
 
 class StatError(Exception):
     pass
 
 class ParserError(Exception):
     pass
+
+class DiffError(Exception):
+    pass
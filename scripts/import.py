@@ -4,14 +4,17 @@ import os
 import sys
 import ssl
 import glob
+import time
 import yaml
-import dppylib
+import socket
 import dpimport
 import logging
+import dpimport.scheduler as scheduler
 import argparse as ap
 import collections as col
-import dpimport.importer as importer
-from dpimport.database import Database
+from timeit import default_timer as timer
+from tools import database as dbtools
+from dpimport.database import Database, Heartbeat
 
 logger = logging.getLogger(__name__)
 
@@ -20,9 +23,39 @@ def main():
     parser.add_argument('-c', '--config')
     parser.add_argument('-d', '--dbname', default='dpdata')
     parser.add_argument('-v', '--verbose', action='store_true')
-    parser.add_argument('expr')
+    parser.add_argument('--files-from',
+        help='Read newline or NUL separated file paths from this file (use - for stdin)')
+    parser.add_argument('--coordinate', action='store_true',
+        help='Coordinate with other workers through leases stored in the database')
+    parser.add_argument('--worker-id',
+        help='Worker identifier used with --coordinate (default: hostname:pid)')
+    parser.add_argument('--run-id',
+        help='Identifier shared by the workers of one coordinated import, used to summarize throughput (default: worker id)')
+    parser.add_argument('--lease-ttl', type=int, default=60,
+        help='Seconds before a lease held by an unresponsive worker expires')
+    parser.add_argument('--diff-metadata', action='store_true',
+        help='Update changed rows of modified metadata files in place instead of reloading them')
+    parser.add_argument('--policy', choices=scheduler.POLICIES, default=scheduler.Policy.NEWEST,
+        help='Order in which files are imported (default: newest)')
+    parser.add_argument('--time-budget', type=float,
+        help='Stop importing after this many seconds and save the remaining files for the next run')
+    parser.add_argument('--verify', action='store_true',
+        help='Compare the row count of each file with the rows recorded at import and flag mismatches for reimport')
+    parser.add_argument('--verify-checksums', action='store_true',
+        help='With --verify, also re-read each file and compare the checksum of every imported batch')
+    parser.add_argument('--cleanup', action='store_true',
+        help='Remove dirty and out of sync documents left behind by failed runs before importing')
+    parser.add_argument('--dry-run', action='store_true',
+        help='Report what --cleanup would remove and exit')
+    parser.add_argument('expr', nargs='*')
     args = parser.parse_args()
 
+    if not args.expr and not args.files_from and not args.cleanup:
+        parser.error('at least one expr or --files-from is required')
+    if args.cleanup and args.coordinate:
+        # other workers' in-progress references are dirty and would be removed
+        parser.error('--cleanup cannot be combined with --coordinate')
+
     level = logging.INFO
     if args.verbose:
         level = logging.DEBUG
@@ -31,37 +64,226 @@ def main():
     with open(os.path.expanduser(args.config), 'r') as fo:
         config = yaml.load(fo, Loader=yaml.SafeLoader)
 
+    # one connection is shared by every expression
     db = Database(config, args.dbname).connect()
 
-    # iterate over matching files on the filesystem
-    for f in glob.iglob(args.expr):
-        dirname = os.path.dirname(f)
-        basename = os.path.basename(f)
-        # probe for dpdash-compatibility and gather information
-        probe = dpimport.probe(f)
-        if not probe:
-            logger.debug('document is unknown %s', basename)
-            continue
-        # nothing to be done
-        if db.exists(probe):
-            logger.info('document exists and is up to date %s', probe['path'])
-            continue
-        logger.info('document does not exist or is out of date %s', probe['path'])
-        # mark matching documents as unsynced (probably unnecessary)
-        logger.info('flipping sync to false for documents matching %s', probe['glob'])
-        db.unsync(probe['glob'])
-        # remove unsynced documents
-        logger.info('removing all unsynced documents matching %s', probe['glob'])
-        db.remove_unsynced(probe['glob'])
-        # import the file
-        logger.info('importing file %s', f)
-        dppylib.import_file(db.db, probe)
+    if args.cleanup:
+        action = 'would remove' if args.dry_run else 'removed'
+        dirty = dbtools.sanitize(db.db, args.dry_run)
+        logger.info('%s %s dirty references and %s documents in %s collections',
+            action, dirty['references'], dirty['documents'], dirty['collections'])
+        out_of_sync = clean_toc(db.db, args.dry_run)
+        logger.info('%s %s out of sync references and %s documents in %s collections',
+            action, out_of_sync['references'], out_of_sync['documents'], out_of_sync['collections'])
+        if args.dry_run:
+            return
+
+    owner = None
+    if args.coordinate:
+        owner = args.worker_id or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        run = args.run_id or owner
+        logger.info('coordinating as worker %s in run %s', owner, run)
+        db.start_worker(owner, run)
+        heartbeat = Heartbeat(db, owner, args.lease_ttl)
+        heartbeat.start()
+
+    # files left over from a run that ran out of time go first
+    backlog = db.backlog()
+    if backlog:
+        logger.info('resuming %s files from the backlog', len(backlog))
+
+    # probe matching files on the filesystem and keep those that need work
+    found = list()
+    for f in iter_files(args.expr, args.files_from, backlog):
+        probe = probe_path(f)
+        if probe:
+            found.append(probe)
+    probes = [p for p in found if not is_current(db, p)]
+    queued = set(p['path'] for p in probes)
+    db.dequeue([f for f in backlog if f not in queued])
+    backlog = set(backlog)
+
+    queue = col.deque(scheduler.schedule(probes, args.policy, first=backlog))
+    logger.info('scheduled %s files using the %s policy', len(queue), args.policy)
+
+    start = timer()
+    def expired():
+        return args.time_budget is not None and timer() - start >= args.time_budget
+
+    deferred = list()
+    while queue and not expired():
+        probe = queue.popleft()
+        if not import_leased(db, probe, owner, args.lease_ttl, args.diff_metadata):
+            deferred.append(probe)
+        elif probe['path'] in backlog:
+            db.dequeue([probe['path']])
+
+    # revisit files that were leased by other workers, those leases are
+    # released once imported or expire if the worker holding them died
+    while deferred and not expired():
+        logger.info('waiting on %s files leased by other workers', len(deferred))
+        time.sleep(min(5, args.lease_ttl / 3.0))
+        deferred = [p for p in deferred if not import_leased(db, p, owner, args.lease_ttl, args.diff_metadata)]
+
+    remaining = deferred + list(queue)
+    if remaining:
+        logger.info('time budget exhausted, saving %s files to the backlog', len(remaining))
+        db.enqueue(remaining)
 
+    if args.verify:
+        import dppylib
+        skipped = set(p['path'] for p in remaining)
+        verified = 0
+        flagged = 0
+        for probe in found:
+            # verification shares the time budget with importing
+            if expired():
+                logger.info('time budget exhausted, stopping verification')
+                break
+            if probe['path'] in skipped:
+                continue
+            verified += 1
+            if dppylib.verify_file(db.db, probe, args.verify_checksums) is False:
+                flagged += 1
+        logger.info('verified %s files, %s flagged for reimport', verified, flagged)
+
+    if owner:
+        # only one worker may rewrite study metadata at a time
+        while not db.acquire_lease('clean_metadata', owner, args.lease_ttl):
+            time.sleep(min(5, args.lease_ttl / 3.0))
     logger.info('cleaning metadata')
     lastday = get_lastday(db.db)
     if lastday:
         clean_metadata(db.db, lastday)
 
+    if owner:
+        db.release_lease('clean_metadata', owner)
+        heartbeat.stop()
+        for node in db.throughput(run):
+            elapsed = (node['heartbeat'] - node['started']).total_seconds() or 1
+            logger.info('node %s: %s workers, %s files, %s bytes, %.1f files/s, %.1f bytes/s',
+                node['_id'], node['workers'], node['files'], node['bytes'],
+                node['files'] / elapsed, node['bytes'] / elapsed)
+
+def probe_path(f):
+    '''
+    Probe a file for DPdash compatibility
+
+    :param f: File path
+    :type f: str
+    '''
+    probe = dpimport.probe(f)
+    if not probe:
+        logger.debug('document is unknown %s', os.path.basename(f))
+    return probe
+
+def is_current(db, probe):
+    '''
+    Check whether the database is already up to date with a file
+
+    :param db: Database
+    :type db: dpimport.database.Database
+    :param probe: File probe
+    :type probe: dict
+    '''
+    if db.exists(probe):
+        logger.info('document exists and is up to date %s', probe['path'])
+        return True
+    return False
+
+def import_leased(db, probe, owner=None, ttl=None, diff_metadata=False):
+    '''
+    Import a probed file. When owner is given the file's glob is
+    leased for the duration of the import, and False is returned
+    if another worker holds that lease.
+
+    :param db: Database
+    :type db: dpimport.database.Database
+    :param probe: File probe
+    :type probe: dict
+    :param owner: Worker identifier
+    :type owner: str
+    :param ttl: Lease duration in seconds
+    :type ttl: int
+    :param diff_metadata: Update modified metadata files row by row
+    :type diff_metadata: bool
+    '''
+    if not owner:
+        import_probe(db, probe, diff_metadata)
+        return True
+    if not db.acquire_lease(probe['glob'], owner, ttl):
+        logger.info('documents matching %s are leased by another worker', probe['glob'])
+        return False
+    try:
+        # another worker may have imported the file while we waited
+        if db.exists(probe):
+            logger.info('document exists and is up to date %s', probe['path'])
+            return True
+        if import_probe(db, probe, diff_metadata) == 0:
+            db.record_progress(owner, probe['size'])
+    finally:
+        db.release_lease(probe['glob'], owner)
+    return True
+
+# Import a probed file, returns 0 on success and 1 on failure
+def import_probe(db, probe, diff_metadata=False):
+    logger.info('document does not exist or is out of date %s', probe['path'])
+    # mark matching documents as unsynced (probably unnecessary)
+    logger.info('flipping sync to false for documents matching %s', probe['glob'])
+    db.unsync(probe['glob'])
+    # remove unsynced documents
+    logger.info('removing all unsynced documents matching %s', probe['glob'])
+    db.remove_unsynced(probe['glob'])
+    # import the file, dppylib is only loaded once there is work to do
+    import dppylib
+    logger.info('importing file %s', probe['path'])
+    return dppylib.import_file(db.db, probe, diff_metadata)
+
+def iter_files(exprs, files_from=None, paths=None):
+    '''
+    Yield existing file paths from a list of literal paths, followed
+    by file paths matching each glob expression, followed by any
+    existing paths listed in a newline or NUL separated file list.
+    Each path is only yielded once.
+
+    :param exprs: shell-style expressions
+    :type exprs: list
+    :param files_from: file list path, or - for stdin
+    :type files_from: str
+    :param paths: literal file paths, not treated as expressions
+    :type paths: list
+    '''
+    seen = set()
+    def literal(f):
+        if not f or f in seen:
+            return False
+        seen.add(f)
+        # listed files may have been removed since the list was made
+        if not os.path.exists(f):
+            logger.warning('file not found %s', f)
+            return False
+        return True
+    for f in paths or []:
+        if literal(f):
+            yield f
+    for expr in exprs:
+        for f in glob.iglob(expr):
+            if f not in seen:
+                seen.add(f)
+                yield f
+    if not files_from:
+        return
+    if files_from == '-':
+        content = sys.stdin.read()
+    else:
+        with open(os.path.expanduser(files_from), 'r') as fo:
+            content = fo.read()
+    sep = '\0' if '\0' in content else '\n'
+    for f in content.split(sep):
+        f = f.strip('\r\n')
+        if literal(f):
+            yield f
+
 def clean_metadata(db, max_days):
     studies = col.defaultdict()
     subjects = list()
@@ -105,21 +327,23 @@ def clean_metadata(db, max_days):
 
         studies[subject['_id']['study']]['subject'].append(subject_metadata)
 
+    from pymongo import UpdateMany, DeleteMany
+    from pymongo.errors import BulkWriteError
     for study, subject in iter(studies.items()):
-        bulk_metadata = db.metadata.initialize_ordered_bulk_op()
-        bulk_metadata.find({'study' : study}).upsert().update({'$set' :
-            {
-                'synced' : True,
-                'subjects' : studies[study]['subject'],
-                'days' : studies[study]['max_day']
-            }
-        })
-
-        bulk_metadata.find({'study' : study, 'synced' : False}).remove()
-        bulk_metadata.find({'study' : study }).update({'$set' : {'synced' : False}})
+        bulk_metadata = [
+            UpdateMany({'study' : study}, {'$set' :
+                {
+                    'synced' : True,
+                    'subjects' : studies[study]['subject'],
+                    'days' : studies[study]['max_day']
+                }
+            }, upsert=True),
+            DeleteMany({'study' : study, 'synced' : False}),
+            UpdateMany({'study' : study }, {'$set' : {'synced' : False}})
+        ]
 
         try:
-            bulk_metadata.execute()
+            db.metadata.bulk_write(bulk_metadata, ordered=True)
         except BulkWriteError as e:
             logger.error(e)
 
@@ -141,68 +365,36 @@ def get_lastday(db):
         }
     ]))
 
-def clean_toc(db):
+def clean_toc(db, dry_run=False):
     logger.info('cleaning table of contents')
-    out_of_sync_tocs = db.toc.find(
-        {
-            'synced' : False
-        },
-        {
-            '_id' : False,
-            'collection' : True,
-            'path' : True 
+    return remove_out_of_sync(db, {
+        'synced' : False,
+        'dirty' : {
+            '$ne' : True
         }
-    )
-    
-    for doc in out_of_sync_tocs:
-        db[doc['collection']].delete_many(
-            {
-                'path' : doc['path']
-            }
-        )
+    }, dry_run)
 
-    bulk = db.toc.initialize_ordered_bulk_op()
-    bulk.find(
-        {
-            'synced' : False
-        }
-    ).remove()
-    try:
-        bulk.execute()
-    except BulkWriteError as e:
-        logger.error(e)
-
-def clean_toc_study(db, study):
+def clean_toc_study(db, study, dry_run=False):
     logger.info('cleaning table of contents for {0}'.format(study))
-    out_of_sync_tocs = db.toc.find(
-        {
-            'study' : study,
-            'synced' : False
-        },
-        {
-            '_id' : False,
-            'collection' : True,
-            'path' : True 
+    return remove_out_of_sync(db, {
+        'study' : study,
+        'synced' : False,
+        'dirty' : {
+            '$ne' : True
         }
-    )
-    for doc in out_of_sync_tocs:
-        db[doc['collection']].delete_many(
-            {
-                'path' : doc['path']
-            }
-        )
+    }, dry_run)
 
-    bulk = db.toc.initialize_ordered_bulk_op()
-    bulk.find(
+# Dirty references are left to tools.database.sanitize, so a dry run
+# of both does not count them twice
+def remove_out_of_sync(db, query, dry_run=False):
+    out_of_sync_tocs = list(db.toc.find(
+        query,
         {
-            'study' : study,
-            'synced' : False
+            'collection' : True,
+            'path' : True
         }
-    ).remove()
-    try:
-        bulk.execute()
-    except BulkWriteError as e:
-        logger.error(e)
+    ))
+    return dbtools.remove_docs(db, db.toc, out_of_sync_tocs, 'data', dry_run)
 
 if __name__ == '__main__':
     main()
@@ -24,5 +24,8 @@ setup(
     scripts=[
         'scripts/import.py'
     ],
-    install_requires=requires
+    install_requires=requires,
+    extras_require={
+        'zstd': ['zstandard']
+    }
 )
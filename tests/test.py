@@ -0,0 +1,624 @@
+import os
+import io
+import sys
+import importlib.util
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+def load_script():
+    # import.py is not importable by name
+    path = os.path.join(here, '..', 'scripts', 'import.py')
+    spec = importlib.util.spec_from_file_location('import_script', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+script = load_script()
+
+def touch(path):
+    with open(path, 'w') as fo:
+        fo.write('a,b\n1,2\n')
+    return path
+
+def test_iter_files_globs_are_deduplicated(tmpdir):
+    a = touch(str(tmpdir.join('a.csv')))
+    b = touch(str(tmpdir.join('b.csv')))
+    exprs = [str(tmpdir.join('*.csv')), a]
+    assert sorted(script.iter_files(exprs)) == [a, b]
+
+def test_iter_files_newline_list(tmpdir):
+    a = touch(str(tmpdir.join('a.csv')))
+    b = touch(str(tmpdir.join('b.csv')))
+    listing = tmpdir.join('list')
+    listing.write('{0}\r\n{1}\n{0}\n\n'.format(a, b))
+    assert list(script.iter_files([], str(listing))) == [a, b]
+
+def test_iter_files_nul_list(tmpdir):
+    # newlines are valid in file names when the list is NUL separated
+    a = touch(str(tmpdir.join('a\nb.csv')))
+    listing = tmpdir.join('list')
+    listing.write('{0}\0'.format(a))
+    assert list(script.iter_files([], str(listing))) == [a]
+
+def test_iter_files_stdin(tmpdir, monkeypatch):
+    a = touch(str(tmpdir.join('a.csv')))
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(a + '\n'))
+    assert list(script.iter_files([], '-')) == [a]
+
+def test_iter_files_skips_missing(tmpdir):
+    a = touch(str(tmpdir.join('a.csv')))
+    listing = tmpdir.join('list')
+    listing.write('{0}\n{1}\n'.format(tmpdir.join('gone.csv'), a))
+    assert list(script.iter_files([], str(listing))) == [a]
+
+def test_probe_missing_file(tmpdir):
+    import dpimport
+    assert dpimport.probe(str(tmpdir.join('STUDY-SUB-accel-day1to30.csv'))) is None
+
+class FakeResult(object):
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+class FakeCollection(object):
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+        self.queries = list()
+        self.dropped = False
+
+    def _match(self, query):
+        (field, cond), = query.items()
+        return [d for d in self.docs if d.get(field) in cond['$in']]
+
+    def count_documents(self, query):
+        self.queries.append(query)
+        return len(self._match(query))
+
+    def delete_many(self, query):
+        self.queries.append(query)
+        matched = self._match(query)
+        self.docs = [d for d in self.docs if d not in matched]
+        return FakeResult(len(matched))
+
+    def find(self, query):
+        return [dict(d) for d in self.docs]
+
+    def bulk_write(self, requests, ordered=True):
+        self.requests = list(requests)
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+    def drop(self):
+        self.dropped = True
+        self.docs = []
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+def fake_toc():
+    db = FakeDatabase()
+    db['one'] = FakeCollection([{ 'path': 'a' }, { 'path': 'a' }, { 'path': 'b' }, { 'path': 'keep' }])
+    db['two'] = FakeCollection([{ 'path': 'c' }])
+    db['toc'] = FakeCollection([{ '_id': i } for i in range(3)])
+    docs = [
+        { '_id': 0, 'collection': 'one', 'path': 'a' },
+        { '_id': 1, 'collection': 'one', 'path': 'b' },
+        { '_id': 2, 'collection': 'two', 'path': 'c' }
+    ]
+    return db, docs
+
+def test_remove_docs_groups_by_collection():
+    from tools import database as dbtools
+    db, docs = fake_toc()
+    summary = dbtools.remove_docs(db, db['toc'], docs, 'data')
+    assert summary == { 'references': 3, 'collections': 2, 'documents': 4 }
+    # one query per collection
+    assert db['one'].queries == [{ 'path': { '$in': ['a', 'b'] } }]
+    assert db['two'].queries == [{ 'path': { '$in': ['c'] } }]
+    assert db['one'].docs == [{ 'path': 'keep' }]
+    assert db['toc'].queries == [{ '_id': { '$in': [0, 1, 2] } }]
+
+def test_remove_docs_dry_run():
+    from tools import database as dbtools
+    db, docs = fake_toc()
+    summary = dbtools.remove_docs(db, db['toc'], docs, 'data', dry_run=True)
+    assert summary == { 'references': 3, 'collections': 2, 'documents': 4 }
+    assert len(db['one'].docs) == 4
+    assert db['toc'].queries == []
+
+def test_remove_docs_metadata_drops_collections():
+    from tools import database as dbtools
+    db = FakeDatabase()
+    db['meta'] = FakeCollection([{ 'Subject ID': 'x' }, { 'Subject ID': 'y' }])
+    docs = [{ '_id': 0, 'collection': 'meta', 'path': 'STUDY_metadata.csv' }]
+    summary = dbtools.remove_docs(db, db['metadata'], docs, 'metadata')
+    assert summary == { 'references': 1, 'collections': 1, 'documents': 2 }
+    assert db['meta'].dropped
+
+def test_remove_docs_chunks_in_queries(monkeypatch):
+    from tools import database as dbtools
+    monkeypatch.setattr(dbtools, 'IN_CHUNK_SIZE', 1)
+    db, docs = fake_toc()
+    summary = dbtools.remove_docs(db, db['toc'], docs, 'data', dry_run=True)
+    assert summary['documents'] == 4
+    assert db['one'].queries == [{ 'path': { '$in': ['a'] } }, { 'path': { '$in': ['b'] } }]
+
+def test_iter_files_literal_paths_first(tmpdir):
+    # backlog paths are not glob expressions
+    a = touch(str(tmpdir.join('a[1].csv')))
+    b = touch(str(tmpdir.join('b.csv')))
+    exprs = [str(tmpdir.join('*.csv'))]
+    missing = str(tmpdir.join('gone.csv'))
+    assert list(script.iter_files(exprs, paths=[a, missing])) == [a, b]
+
+def probes():
+    return [
+        { 'path': 'a1', 'study': 'A', 'mtime': 5, 'size': 30 },
+        { 'path': 'a2', 'study': 'A', 'mtime': 4, 'size': 10 },
+        { 'path': 'a3', 'study': 'A', 'mtime': 3, 'size': 20 },
+        { 'path': 'b1', 'study': 'B', 'mtime': 1, 'size': 50 },
+        { 'path': 'b2', 'study': 'B', 'mtime': 2, 'size': 40 }
+    ]
+
+def paths(ordered):
+    return [p['path'] for p in ordered]
+
+def test_order_none():
+    import dpimport.scheduler as scheduler
+    assert paths(scheduler.order(probes(), scheduler.Policy.NONE)) == ['a1', 'a2', 'a3', 'b1', 'b2']
+
+def test_order_newest():
+    import dpimport.scheduler as scheduler
+    assert paths(scheduler.order(probes(), scheduler.Policy.NEWEST)) == ['a1', 'a2', 'a3', 'b2', 'b1']
+
+def test_order_smallest():
+    import dpimport.scheduler as scheduler
+    assert paths(scheduler.order(probes(), scheduler.Policy.SMALLEST)) == ['a2', 'a3', 'a1', 'b2', 'b1']
+
+def test_order_fair():
+    import dpimport.scheduler as scheduler
+    assert paths(scheduler.order(probes(), scheduler.Policy.FAIR)) == ['a1', 'b2', 'a2', 'b1', 'a3']
+
+def test_order_unknown_policy():
+    import pytest
+    import dpimport.scheduler as scheduler
+    with pytest.raises(ValueError):
+        scheduler.order(probes(), 'largest')
+
+def test_schedule_backlog_first():
+    import dpimport.scheduler as scheduler
+    ordered = scheduler.schedule(probes(), scheduler.Policy.NEWEST, first={'b1', 'a3'})
+    assert paths(ordered) == ['a3', 'b1', 'a1', 'a2', 'b2']
+
+def write(path, content):
+    with open(path, 'wb') as fo:
+        fo.write(content)
+    return path
+
+def test_count_rows(tmpdir):
+    from tools import reader
+    cases = [
+        (b'', 0),
+        (b'\n\n', 0),
+        (b'h\n', 0),
+        (b'h\n1\n2\n', 2),
+        (b'h\n1\n2', 2),
+        (b'h\r\n1\r\n2\r\n', 2),
+        (b'h\n1\n2\n\n\r\n', 2)
+    ]
+    for content,rows in cases:
+        path = write(str(tmpdir.join('f.csv')), content)
+        assert reader.count_rows(path) == rows, content
+
+def test_count_rows_uncountable(tmpdir):
+    from tools import reader
+    for content in (b'h\n1\n\n2\n', b'\nh\n1\n', b'h\n"a\nb"\n', b'h\r1\r2\r'):
+        path = write(str(tmpdir.join('f.csv')), content)
+        assert reader.count_rows(path) is None, content
+        for window in (1, 2, 3):
+            assert reader.count_rows(path, window) is None, (content, window)
+
+def test_count_rows_across_windows(tmpdir):
+    from tools import reader
+    path = write(str(tmpdir.join('f.csv')), b'h\r\n1\r\n2\r\n\r\n')
+    for window in (1, 2, 3):
+        assert reader.count_rows(path, window) == 2
+    path = write(str(tmpdir.join('f.csv')), b'h\n1\n\n2\n')
+    for window in (1, 2, 3):
+        assert reader.count_rows(path, window) is None
+
+def test_count_rows_gzip(tmpdir):
+    import gzip
+    from tools import reader
+    path = write(str(tmpdir.join('f.csv.gz')), gzip.compress(b'h\n1\n2\n3\n'))
+    assert reader.count_rows(path) == 3
+    assert reader.count_rows(path, 2) == 3
+    path = write(str(tmpdir.join('e.csv.gz')), gzip.compress(b''))
+    assert reader.count_rows(path) == 0
+
+def test_count_rows_zstd_without_zstandard(tmpdir, monkeypatch):
+    import pytest
+    from tools import reader
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    path = write(str(tmpdir.join('f.csv.zst')), b'')
+    with pytest.raises(ImportError):
+        reader.count_rows(path)
+
+def mock_database():
+    mongomock = __import__('pytest').importorskip('mongomock')
+    from dpimport.database import Database
+    db = Database({}, 'dpdata')
+    db.client = mongomock.MongoClient()
+    db.db = db.client[db.dbname]
+    return db
+
+def datafile(tmpdir, rows=3, name='STUDY-SUB001-accel-day1to3.csv'):
+    lines = ['day,value'] + ['{0},{1}'.format(i + 1, i * 10) for i in range(rows)]
+    return write(str(tmpdir.join(name)), '\n'.join(lines).encode('utf-8') + b'\n')
+
+def test_exists_ignores_dirty_entries(tmpdir):
+    import dpimport
+    db = mock_database()
+    probe = dpimport.probe(datafile(tmpdir))
+    db.db.toc.insert_one(dict(probe))
+    assert not db.exists(probe)
+    db.db.toc.update_many({}, { '$set': { 'dirty': False, 'synced': True } })
+    assert db.exists(probe)
+
+def test_expired_lease_reimports_partial_file(tmpdir):
+    import dpimport
+    from datetime import datetime, timedelta
+    db = mock_database()
+    probe = dpimport.probe(datafile(tmpdir))
+    # a worker died after writing the toc entry and one row
+    db.db.toc.insert_one(dict(probe))
+    db.db[probe['collection']].insert_one({ 'day': 1, 'value': 0, 'path': probe['path'] })
+    db.db.leases.insert_one({
+        '_id': probe['glob'],
+        'owner': 'dead',
+        'expires': datetime.utcnow() - timedelta(seconds=1)
+    })
+    assert not script.is_current(db, probe)
+    assert script.import_leased(db, probe, 'alive', 60)
+    toc = list(db.db.toc.find())
+    assert len(toc) == 1
+    assert toc[0]['synced'] and not toc[0]['dirty']
+    assert db.db[probe['collection']].count_documents({ 'path': probe['path'] }) == 3
+    assert db.db.leases.count_documents({}) == 0
+
+def test_progress_only_recorded_on_success(tmpdir, monkeypatch):
+    import dpimport
+    import dppylib
+    db = mock_database()
+    db.start_worker('alive', 'run')
+    good = dpimport.probe(datafile(tmpdir))
+    bad = dpimport.probe(datafile(tmpdir, name='STUDY-SUB002-accel-day1to3.csv'))
+    assert script.import_leased(db, good, 'alive', 60)
+    monkeypatch.setattr(dppylib, 'insert_data', lambda db, file_info, batches=None: 1)
+    assert script.import_leased(db, bad, 'alive', 60)
+    worker = db.db.workers.find_one({ '_id': 'alive' })
+    assert worker['files'] == 1
+    assert worker['bytes'] == good['size']
+
+def test_acquire_lease():
+    from datetime import datetime, timedelta
+    db = mock_database()
+    # free key
+    assert db.acquire_lease('glob', 'a', 60)
+    # held by the same owner
+    assert db.acquire_lease('glob', 'a', 60)
+    # held by a live worker
+    assert not db.acquire_lease('glob', 'b', 60)
+    assert db.db.leases.find_one({ '_id': 'glob' })['owner'] == 'a'
+    # held by a worker that stopped renewing it
+    db.db.leases.update_one({ '_id': 'glob' }, {
+        '$set': { 'expires': datetime.utcnow() - timedelta(seconds=1) }
+    })
+    assert db.acquire_lease('glob', 'b', 60)
+    assert db.db.leases.find_one({ '_id': 'glob' })['owner'] == 'b'
+
+def test_release_lease_only_by_owner():
+    db = mock_database()
+    db.acquire_lease('glob', 'a', 60)
+    db.release_lease('glob', 'b')
+    assert db.db.leases.count_documents({}) == 1
+    db.release_lease('glob', 'a')
+    assert db.db.leases.count_documents({}) == 0
+
+def test_renew_leases():
+    from datetime import datetime, timedelta
+    db = mock_database()
+    db.start_worker('a', 'run')
+    db.acquire_lease('one', 'a', 1)
+    db.acquire_lease('two', 'a', 1)
+    db.acquire_lease('three', 'b', 1)
+    db.renew_leases('a', 600)
+    soon = datetime.utcnow() + timedelta(seconds=300)
+    leases = dict((l['_id'], l['expires']) for l in db.db.leases.find())
+    assert leases['one'] > soon and leases['two'] > soon
+    assert leases['three'] < soon
+    assert db.db.workers.find_one({ '_id': 'a' })['heartbeat'] <= datetime.utcnow()
+
+def test_throughput_per_run():
+    db = mock_database()
+    db.start_worker('a', 'old')
+    db.record_progress('a', 100)
+    # restarting a worker resets its counters
+    db.start_worker('a', 'new')
+    db.start_worker('b', 'new')
+    db.start_worker('c', 'old')
+    db.record_progress('a', 10)
+    db.record_progress('b', 20)
+    db.record_progress('b', 30)
+    db.record_progress('c', 1000)
+    nodes = db.throughput('new')
+    assert len(nodes) == 1
+    assert nodes[0]['workers'] == 2
+    assert nodes[0]['files'] == 3
+    assert nodes[0]['bytes'] == 60
+
+def local_mongod():
+    import pytest
+    pymongo = pytest.importorskip('pymongo')
+    client = pymongo.MongoClient('localhost', 27017, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except Exception:
+        pytest.skip('no mongod listening on localhost:27017')
+    return client
+
+def test_coordinated_workers(tmpdir):
+    import uuid
+    import time
+    import dpimport
+    import subprocess as sp
+    from datetime import datetime, timedelta
+    client = local_mongod()
+    dbname = 'dpimport_test_{0}'.format(uuid.uuid4().hex)
+    config = tmpdir.join('config.yml')
+    config.write('hostname: localhost\nport: 27017\nssl: false\n')
+    data = tmpdir.mkdir('data')
+    files = [datafile(data, rows=50, name='STUDY-SUB{0:03d}-accel-day1to50.csv'.format(i)) for i in range(20)]
+    command = [
+        sys.executable, os.path.join(here, '..', 'scripts', 'import.py'),
+        '-c', str(config), '-d', dbname, '--coordinate', '--lease-ttl', '2',
+        '--run-id', 'test', str(data.join('*.csv'))
+    ]
+    try:
+        db = client[dbname]
+        # a worker that died holding a lease, after writing part of a file
+        probe = dpimport.probe(files[0])
+        db.toc.insert_one(dict(probe))
+        db[probe['collection']].insert_one({ 'day': 1, 'value': 0, 'path': probe['path'] })
+        db.leases.insert_one({
+            '_id': probe['glob'],
+            'owner': 'dead',
+            'expires': datetime.utcnow() + timedelta(seconds=2)
+        })
+        # and one killed partway through its run
+        killed = sp.Popen(command + ['--worker-id', 'killed'], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        time.sleep(1)
+        killed.kill()
+        killed.wait()
+
+        workers = [sp.Popen(command + ['--worker-id', 'worker{0}'.format(i)], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+            for i in range(4)]
+        for worker in workers:
+            assert worker.wait(timeout=120) == 0
+
+        for f in files:
+            docs = list(db.toc.find({ 'path': f }))
+            assert len(docs) == 1, f
+            assert docs[0]['synced'] and not docs[0]['dirty']
+            assert db[docs[0]['collection']].count_documents({ 'path': f }) == 50, f
+        assert db.leases.count_documents({}) == 0
+        assert db.workers.count_documents({ 'run': 'test', '_id': { '$ne': 'killed' } }) == 4
+    finally:
+        client.drop_database(dbname)
+
+def test_cleanup_rejected_with_coordinate(monkeypatch):
+    import pytest
+    monkeypatch.setattr(sys, 'argv', ['import.py', '-c', 'config.yml', '--cleanup', '--coordinate'])
+    with pytest.raises(SystemExit):
+        script.main()
+
+def metadata_file(tmpdir, rows, header='Subject ID,Consent'):
+    lines = [header] + rows
+    return write(str(tmpdir.join('STUDY_metadata.csv')), '\n'.join(lines).encode('utf-8') + b'\n')
+
+def test_update_rows(tmpdir):
+    import dpimport
+    import dppylib
+    from pymongo import ReplaceOne, DeleteMany
+    path = metadata_file(tmpdir, ['SUB001,yes', 'SUB002,no', 'SUB004,yes'])
+    file_info = dpimport.probe(path)
+    file_info['collection'] = 'meta'
+    db = FakeDatabase()
+    db['meta'] = FakeCollection([
+        { '_id': 1, 'Subject ID': 'SUB001', 'Consent': 'yes', 'path': path },
+        { '_id': 2, 'Subject ID': 'SUB002', 'Consent': 'yes', 'path': path },
+        { '_id': 3, 'Subject ID': 'SUB003', 'Consent': 'yes', 'path': path }
+    ])
+    counts = dict()
+    assert dppylib.update_rows(db, file_info, 'Subject ID', counts) == 0
+    assert counts == { 'rows': 3 }
+    assert db['meta'].requests == [
+        ReplaceOne({ 'Subject ID': 'SUB002' }, { 'Subject ID': 'SUB002', 'Consent': 'no', 'path': path }, upsert=True),
+        ReplaceOne({ 'Subject ID': 'SUB004' }, { 'Subject ID': 'SUB004', 'Consent': 'yes', 'path': path }, upsert=True),
+        DeleteMany({ 'Subject ID': { '$in': ['SUB003'] } })
+    ]
+
+def test_update_rows_unchanged(tmpdir):
+    import dpimport
+    import dppylib
+    path = metadata_file(tmpdir, ['SUB001,yes'])
+    file_info = dpimport.probe(path)
+    file_info['collection'] = 'meta'
+    db = FakeDatabase()
+    db['meta'] = FakeCollection([{ '_id': 1, 'Subject ID': 'SUB001', 'Consent': 'yes', 'path': path }])
+    assert dppylib.update_rows(db, file_info, 'Subject ID') == 0
+    assert not hasattr(db['meta'], 'requests')
+
+def test_update_rows_cannot_diff(tmpdir):
+    import pytest
+    import dpimport
+    import dppylib
+    cases = [
+        (['SUB001,yes'], 'Subject,Consent', []),
+        (['SUB001,yes', 'SUB001,no'], 'Subject ID,Consent', []),
+        (['SUB001,yes'], 'Subject ID,Consent', [{ '_id': 1, 'Subject ID': 'SUB002' }, { '_id': 2, 'Subject ID': 'SUB002' }])
+    ]
+    for rows,header,stored in cases:
+        file_info = dpimport.probe(metadata_file(tmpdir, rows, header))
+        file_info['collection'] = 'meta'
+        db = FakeDatabase()
+        db['meta'] = FakeCollection(stored)
+        with pytest.raises(dppylib.DiffError):
+            dppylib.update_rows(db, file_info, 'Subject ID')
+
+def import_metadata(db, path, diff_metadata=True):
+    import dpimport
+    import dppylib
+    assert dppylib.import_file(db.db, dpimport.probe(path), diff_metadata) == 0
+    return db.db.metadata.find_one({ 'path': path })
+
+def touch_later(path):
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+def test_update_metadata_keeps_collection(tmpdir):
+    db = mock_database()
+    path = metadata_file(tmpdir, ['SUB001,yes', 'SUB002,yes'])
+    ref = import_metadata(db, path)
+    metadata_file(tmpdir, ['SUB001,yes', 'SUB002,no', 'SUB003,yes'])
+    touch_later(path)
+    updated = import_metadata(db, path)
+    assert updated['_id'] == ref['_id']
+    assert updated['collection'] == ref['collection']
+    assert updated['rows'] == updated['inserted'] == 3
+    assert updated['synced']
+    rows = db.db[ref['collection']].find({}, { '_id': False, 'path': False })
+    assert sorted((r['Subject ID'], r['Consent']) for r in rows) == [('SUB001', 'yes'), ('SUB002', 'no'), ('SUB003', 'yes')]
+
+def test_update_metadata_falls_back_to_reload(tmpdir):
+    db = mock_database()
+    path = metadata_file(tmpdir, ['SUB001,yes'])
+    ref = import_metadata(db, path)
+    metadata_file(tmpdir, ['SUB001,yes', 'SUB001,no'])
+    touch_later(path)
+    reloaded = import_metadata(db, path)
+    assert reloaded['collection'] != ref['collection']
+    assert ref['collection'] not in db.db.list_collection_names()
+    assert db.db[reloaded['collection']].count_documents({}) == 2
+    assert db.db.metadata.count_documents({}) == 1
+
+def import_datafile(db, path):
+    import dpimport
+    import dppylib
+    probe = dpimport.probe(path)
+    assert dppylib.import_file(db.db, probe) == 0
+    return probe, db.db.toc.find_one({ 'path': path })
+
+def test_record_batches(tmpdir, monkeypatch):
+    import dppylib
+    monkeypatch.setattr(dppylib, 'BATCH_SIZE', 2)
+    db = mock_database()
+    _,ref = import_datafile(db, datafile(tmpdir, rows=5))
+    assert ref['rows'] == ref['inserted'] == 5
+    assert [batch['rows'] for batch in ref['batches']] == [2, 2, 1]
+    assert all(batch['inserted'] == batch['rows'] for batch in ref['batches'])
+    assert len(set(batch['checksum'] for batch in ref['batches'])) == 3
+
+def assert_flagged(db, ref):
+    ref = db.db.toc.find_one({ '_id': ref['_id'] })
+    assert ref['verified'] is False and ref['dirty'] and not ref['synced']
+
+def test_verify_file(tmpdir):
+    import dppylib
+    db = mock_database()
+    probe,ref = import_datafile(db, datafile(tmpdir))
+    assert dppylib.verify_file(db.db, probe) is True
+    assert dppylib.verify_file(db.db, probe, checksums=True) is True
+    assert db.exists(probe)
+
+def test_verify_file_count_mismatch(tmpdir):
+    import dppylib
+    db = mock_database()
+    probe,ref = import_datafile(db, datafile(tmpdir))
+    # a row that was read but never stored
+    db.db.toc.update_one({ '_id': ref['_id'] }, { '$set': { 'inserted': 2 } })
+    assert dppylib.verify_file(db.db, probe) is False
+    assert_flagged(db, ref)
+    assert not db.exists(probe)
+
+def test_verify_file_counts_collection_when_uncountable(tmpdir):
+    import dppylib
+    db = mock_database()
+    path = write(str(tmpdir.join('STUDY-SUB001-accel-day1to3.csv')), b'day,value\n1,0\n\n2,10\n3,20\n')
+    probe,ref = import_datafile(db, path)
+    assert ref['rows'] == 3
+    assert dppylib.verify_file(db.db, probe) is True
+    db.db[ref['collection']].delete_one({ 'day': 2 })
+    assert dppylib.verify_file(db.db, probe) is False
+    assert_flagged(db, ref)
+
+def test_verify_file_checksum_mismatch(tmpdir):
+    import dppylib
+    db = mock_database()
+    probe,ref = import_datafile(db, datafile(tmpdir))
+    db.db.toc.update_one({ '_id': ref['_id'] }, { '$set': { 'batches.0.checksum': '0' } })
+    assert dppylib.verify_file(db.db, probe) is True
+    assert dppylib.verify_file(db.db, probe, checksums=True) is False
+    assert_flagged(db, ref)
+
+def test_verify_file_without_counts(tmpdir):
+    import dppylib
+    db = mock_database()
+    probe,ref = import_datafile(db, datafile(tmpdir))
+    db.db.toc.update_one({ '_id': ref['_id'] }, { '$unset': { 'rows': True } })
+    assert dppylib.verify_file(db.db, probe) is None
+
+def test_exists_ignores_unverified(tmpdir):
+    import dppylib
+    db = mock_database()
+    probe,ref = import_datafile(db, datafile(tmpdir))
+    db.db.toc.update_one({ '_id': ref['_id'] }, { '$set': { 'verified': False } })
+    assert not db.exists(probe)
+
+def test_patterns_extensions():
+    from dpimport import patterns
+    for ext in ('.csv', '.csv.gz', '.csv.zst'):
+        match = patterns.DATAFILE.match('STUDY-SUB001-accel-day1to30' + ext)
+        assert match and match.group('extension') == ext
+        match = patterns.METADATA.match('STUDY_metadata' + ext)
+        assert match and match.group('extension') == ext
+    for ext in ('.csv.bak', '.csv.bz2', '.csvx'):
+        assert not patterns.DATAFILE.match('STUDY-SUB001-accel-day1to30' + ext)
+        assert not patterns.METADATA.match('STUDY_metadata' + ext)
+
+def test_get_glob():
+    import dpimport
+    for ext in ('.csv', '.csv.gz', '.csv.zst'):
+        path = '/data/STUDY-SUB001-accel-day1to30' + ext
+        assert dpimport.get_glob(path) == '/data/STUDY-SUB001-accel-day*.csv*'
+
+def test_dppylib_glob_matches_dpimport():
+    import dpimport
+    import dppylib
+    for ext in ('.csv', '.csv.gz', '.csv.zst'):
+        name = 'STUDY-SUB001-accel-day1to30' + ext
+        info = dppylib.match_file(name, '/data')
+        assert info['glob'] == dpimport.get_glob(os.path.join('/data', name))
+        assert info['collection'] == dpimport.init_datafile(info)['collection']
+        assert dppylib.guess_type(ext) == dpimport.guess_type(name)
+
+def test_probe_encoding(tmpdir):
+    import dpimport
+    for ext,encoding in (('.csv', None), ('.csv.gz', 'gzip'), ('.csv.zst', 'zstd')):
+        probe = dpimport.probe(datafile(tmpdir, name='STUDY-SUB001-accel-day1to30' + ext))
+        assert probe['filetype'] == 'text/csv'
+        assert probe['encoding'] == encoding
+        assert probe['extension'] == ext
@@ -1,21 +1,38 @@
 import logging
+import collections as col
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
-def sanitize(db):
-    dirty_files = db.toc.find({
+# Maximum number of values passed to a single $in query
+IN_CHUNK_SIZE = 10000
+
+def sanitize(db, dry_run=False, workers=8):
+    dirty_files = list(db.toc.find({
         'dirty' : True
-    })
-    dirty_metadata = db.metadata.find({
+    }, {
+        'collection' : True,
+        'path' : True
+    }))
+    dirty_metadata = list(db.metadata.find({
         'dirty' : True
-    })
-    for doc in dirty_files:
-        logger.info('{FILE} is outdated. Deleting from the database.'.format(FILE=doc['path']))
-        remove_doc(db, db['toc'], doc, 'data')
+    }, {
+        'collection' : True,
+        'path' : True
+    }))
+    for doc in dirty_files + dirty_metadata:
+        if dry_run:
+            logger.info('{FILE} is outdated. Would delete from the database.'.format(FILE=doc['path']))
+        else:
+            logger.info('{FILE} is outdated. Deleting from the database.'.format(FILE=doc['path']))
 
-    for doc in dirty_metadata:
-        logger.info('{FILE} is outdated. Deleting from the database.'.format(FILE=doc['path']))
-        remove_doc(db, db['metadata'], doc, 'metadata')
+    files = remove_docs(db, db['toc'], dirty_files, 'data', dry_run, workers)
+    metadata = remove_docs(db, db['metadata'], dirty_metadata, 'metadata', dry_run, workers)
+    return {
+        'references' : files['references'] + metadata['references'],
+        'collections' : files['collections'] + metadata['collections'],
+        'documents' : files['documents'] + metadata['documents']
+    }
 
 def remove_doc(db, collection, doc, role):
     try:
@@ -34,3 +51,61 @@ def remove_doc(db, collection, doc, role):
         logger.error(e)
         logger.error('Could not remove {FILE} from the database.'.format(FILE=doc['path']))
         return 1
+
+# Remove many reference docs and their data, grouped by target collection.
+# Returns the number of references, collections and data documents affected.
+def remove_docs(db, collection, docs, role, dry_run=False, workers=8):
+    targets = col.defaultdict(list)
+    for doc in docs:
+        targets[doc['collection']].append(doc['path'])
+
+    def remove_target(target):
+        paths = targets[target]
+        try:
+            if role == 'metadata':
+                count = db[target].estimated_document_count()
+                if not dry_run:
+                    db[target].drop()
+                return count
+            count = 0
+            for chunk in chunks(paths):
+                query = {
+                    'path' : {
+                        '$in' : chunk
+                    }
+                }
+                if dry_run:
+                    count += db[target].count_documents(query)
+                else:
+                    count += db[target].delete_many(query).deleted_count
+            return count
+        except Exception as e:
+            logger.error(e)
+            logger.error('Could not remove {N} files from {COLLECTION}.'.format(N=len(paths), COLLECTION=target))
+            return 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        documents = sum(executor.map(remove_target, targets))
+
+    if not dry_run:
+        ids = [doc['_id'] for doc in docs]
+        for chunk in chunks(ids):
+            try:
+                collection.delete_many({
+                    '_id' : {
+                        '$in' : chunk
+                    }
+                })
+            except Exception as e:
+                logger.error(e)
+
+    return {
+        'references' : len(docs),
+        'collections' : len(targets),
+        'documents' : documents
+    }
+
+def chunks(values, size=None):
+    size = size or IN_CHUNK_SIZE
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
@@ -1,15 +1,116 @@
-import pandas as pd
+import io
+import os
+import re
+import gzip
+import mmap
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Read in the file and yield the dataframe chunk
+# A carriage return that does not start a CRLF line ending
+LONE_CR = re.compile(b'\r[^\n]')
+
+# Compression encodings by file extension
+COMPRESSION = {
+    '.gz' : 'gzip',
+    '.zst' : 'zstd'
+}
+
+# Return the compression encoding of a file, or None if it is uncompressed
+def compression(file_path):
+    _,ext = os.path.splitext(file_path)
+    return COMPRESSION.get(ext)
+
+# Open a file for binary reading, decompressing it on the fly if needed
+def open_file(file_path):
+    encoding = compression(file_path)
+    if encoding == 'gzip':
+        return gzip.open(file_path, 'rb')
+    if encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading {FILE} requires the zstandard package'.format(FILE=file_path))
+        fo = open(file_path, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(fo, closefd=True)
+    return open(file_path, 'rb')
+
+# Read in the file and yield the dataframe chunk. Errors other than an
+# empty file are raised so callers don't mistake them for a file with no rows.
 def read_csv(file_path):
+    # pandas is expensive to import, defer it until there is work to do
+    import pandas as pd
     try:
-        tfr = pd.read_csv(file_path, memory_map=True, keep_default_na=False, chunksize=1, engine='c', skipinitialspace=True)
-        for df in tfr:
-            yield df
-    except pd.io.common.EmptyDataError as e:
+        if compression(file_path):
+            # decompress as the file is read rather than relying on the
+            # compression support of the installed pandas version
+            with io.TextIOWrapper(open_file(file_path), encoding='utf-8') as fo:
+                tfr = pd.read_csv(fo, keep_default_na=False, chunksize=1, engine='c', skipinitialspace=True)
+                for df in tfr:
+                    yield df
+        else:
+            tfr = pd.read_csv(file_path, memory_map=True, keep_default_na=False, chunksize=1, engine='c', skipinitialspace=True)
+            for df in tfr:
+                yield df
+    except pd.errors.EmptyDataError as e:
         logger.error(e)
     except Exception as e:
         logger.error(e)
+        raise
+
+# Count the data rows in a file by scanning for newlines, without parsing it.
+# Returns None if the count may not match what read_csv parses, which is
+# when the file has quoted fields, blank lines before its last row, or
+# lines ending in a bare carriage return.
+def count_rows(file_path, window=16 * 1024 * 1024):
+    if compression(file_path):
+        with open_file(file_path) as fo:
+            return count_lines(iter(lambda: fo.read(window), b''))
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return 0
+    with open(file_path, 'rb') as fo:
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            blocks = (mm[offset:offset + window] for offset in range(0, size, window))
+            return count_lines(blocks)
+
+# Count the data rows in a stream of byte blocks
+def count_lines(blocks):
+    lines = 0
+    content = False
+    # newlines at the end of what has been read so far
+    trailing = b''
+    # the last bytes of the previous block, to find blank lines across blocks
+    carry = b''
+    blank = False
+    for buf in blocks:
+        if b'"' in buf:
+            return None
+        if not content and buf[:1] in (b'\n', b'\r'):
+            # blank lines before the header
+            blank = True
+        stripped = buf.rstrip(b'\r\n')
+        if stripped:
+            if blank:
+                return None
+            content = True
+            trailing = buf[len(stripped):]
+        else:
+            trailing += buf
+        joined = carry + buf
+        if LONE_CR.search(joined):
+            return None
+        found = [i for i in (joined.find(b'\n\n'), joined.find(b'\n\r\n')) if i >= 0]
+        if found:
+            if joined[min(found):].strip(b'\r\n'):
+                return None
+            blank = True
+        carry = joined[-2:]
+        lines += buf.count(b'\n')
+    if not content:
+        return 0
+    # trailing newlines do not start a new row, a missing one does
+    lines -= trailing.count(b'\n')
+    lines += 1
+    # minus the header
+    return max(lines - 1, 0)